@@ -2,18 +2,35 @@
 """UVZ (Unique Value Zone) MCP Server - Research and Digital Product Creation"""
 import os
 import sys
+import asyncio
 import logging
-import json
 import re
+import time
+import random
+import hashlib
+from collections import OrderedDict
+from functools import lru_cache
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone
 import httpx
-from mcp.server.fastmcp import FastMCP
+import orjson
+from mcp.server.fastmcp import FastMCP, Context
 import google.generativeai as genai
-from bs4 import BeautifulSoup
+from selectolax.lexbor import LexborHTMLParser
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', stream=sys.stderr)
 logger = logging.getLogger("uvz-server")
-mcp = FastMCP("uvz")
+_DEFAULT_HEADERS = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"}
+_http_client = httpx.AsyncClient(timeout=httpx.Timeout(15.0, connect=5.0), follow_redirects=True, headers=_DEFAULT_HEADERS, limits=httpx.Limits(max_keepalive_connections=20, max_connections=100), http2=True)
+
+@asynccontextmanager
+async def lifespan(server):
+    try:
+        yield
+    finally:
+        await _http_client.aclose()
+
+mcp = FastMCP("uvz", lifespan=lifespan)
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY", "")
 
 if GEMINI_API_KEY:
@@ -23,36 +40,150 @@ else:
     logger.warning("GEMINI_API_KEY not set")
     model = None
 
+LLM_CACHE_TTL = 1800
+LLM_CACHE_MAX_ENTRIES = 1000
+_llm_cache = OrderedDict()
+
+DDG_SEARCH_URL = "https://html.duckduckgo.com/html/"
+SEARCH_CACHE_TTL = 600
+SEARCH_CACHE_MAX_ENTRIES = 1000
+SEARCH_MAX_RETRIES = 3
+_search_cache = OrderedDict()
+_ddg_semaphore = asyncio.Semaphore(2)
+_ddg_last_request = 0.0
+_ddg_http_version_logged = False
+
+_SANITIZE_RE = re.compile(r'[^\w\s\-,.]')
+_SANITIZE_TABLE = str.maketrans('', '', ''.join(chr(i) for i in range(128) if _SANITIZE_RE.match(chr(i))))
+
+@lru_cache(maxsize=512)
 def sanitize_input(text):
-    return re.sub(r'[^\w\s\-,.]', '', text)
+    if text.isascii():
+        return text.translate(_SANITIZE_TABLE)
+    return _SANITIZE_RE.sub('', text)
 
-async def web_search_free(query):
+def _parse_ddg_html(html):
+    tree = LexborHTMLParser(html)
+    results = []
+    for result in tree.css('div.result')[:10]:
+        title_elem = result.css_first('a.result__a')
+        snippet_elem = result.css_first('a.result__snippet')
+        if title_elem:
+            results.append({'title': title_elem.text(strip=True), 'link': title_elem.attributes.get('href') or '', 'snippet': snippet_elem.text(strip=True) if snippet_elem else ""})
+    throttled = not results and tree.css_first('[class*="anomaly"]') is not None
+    return results, throttled
+
+async def _web_search_free_raw(query):
+    global _ddg_last_request, _ddg_http_version_logged
+    cached = _search_cache.get(query)
+    if cached and time.time() - cached[1] < SEARCH_CACHE_TTL:
+        _search_cache.move_to_end(query)
+        return cached[0]
     try:
-        url = f"https://html.duckduckgo.com/html/?q={query}"
-        headers = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"}
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, headers=headers, timeout=15, follow_redirects=True)
-            response.raise_for_status()
-            soup = BeautifulSoup(response.text, 'html.parser')
-            results = []
-            for result in soup.find_all('div', class_='result', limit=10):
-                title_elem = result.find('a', class_='result__a')
-                snippet_elem = result.find('a', class_='result__snippet')
-                if title_elem:
-                    results.append({'title': title_elem.get_text(strip=True), 'link': title_elem.get('href', ''), 'snippet': snippet_elem.get_text(strip=True) if snippet_elem else ""})
-            return json.dumps(results, indent=2)
+        results = []
+        async with _ddg_semaphore:
+            for attempt in range(SEARCH_MAX_RETRIES):
+                if attempt:
+                    await asyncio.sleep(2 ** attempt)
+                slot = max(time.monotonic(), _ddg_last_request + random.uniform(0.5, 1.5))
+                _ddg_last_request = slot
+                delay = slot - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                response = await _http_client.get(DDG_SEARCH_URL, params={"q": query})
+                if not _ddg_http_version_logged:
+                    _ddg_http_version_logged = True
+                    logger.info("Web search connected over %s", response.http_version)
+                if response.status_code in (202, 429):
+                    logger.warning(f"Web search throttled ({response.status_code}) on attempt {attempt + 1}")
+                    continue
+                response.raise_for_status()
+                results, throttled = await asyncio.to_thread(_parse_ddg_html, response.content)
+                if not throttled:
+                    break
+                logger.warning(f"Web search got an anomaly page on attempt {attempt + 1}")
+        if results:
+            _search_cache[query] = (results, time.time())
+            _search_cache.move_to_end(query)
+            while len(_search_cache) > SEARCH_CACHE_MAX_ENTRIES:
+                _search_cache.popitem(last=False)
+        return results
     except Exception as e:
         logger.error(f"Web search error: {e}")
-        return json.dumps([])
+        return []
+
+async def web_search_free(query):
+    results = await _web_search_free_raw(query)
+    return orjson.dumps(results, option=orjson.OPT_INDENT_2).decode()
+
+def _format_sources(results, limit=None, include_links=True):
+    if include_links:
+        return "\n\n".join(f"{i}. {r['title']}\n{r['snippet']}\n{r['link']}" for i, r in enumerate(results[:limit], start=1))
+    return "\n\n".join(f"{i}. {r['title']}\n{r['snippet']}" for i, r in enumerate(results[:limit], start=1))
+
+def _render_section(value, indent=""):
+    if isinstance(value, dict):
+        items = [(f" **{k}**:", v) for k, v in value.items()]
+    elif isinstance(value, list):
+        items = [("", v) for v in value]
+    else:
+        return str(value)
+    lines = []
+    for label, item in items:
+        if not label and isinstance(item, dict) and item:
+            lines.append(f"{indent}-{_render_section(item, indent + '  ')[len(indent) + 3:]}")
+        elif isinstance(item, (dict, list)):
+            lines.append(f"{indent}-{label}\n{_render_section(item, indent + '  ')}")
+        else:
+            lines.append(f"{indent}-{label} {item}")
+    return "\n".join(lines)
+
+def _generate_text(prompt, generation_config=None):
+    response = model.generate_content(prompt, generation_config=generation_config, stream=True)
+    return "".join(chunk.text for chunk in response)
 
-async def gemini_analyze(prompt):
+async def gemini_analyze(prompt, on_chunk=None, json_output=False):
     if not model:
         return "Error: Gemini API key not configured"
+    generation_config = {"response_mime_type": "application/json"} if json_output else None
+    key = hashlib.sha256(f"{json_output}:{' '.join(prompt.split())}".encode()).hexdigest()
+    cached = _llm_cache.get(key)
+    if cached and time.time() - cached[1] < LLM_CACHE_TTL:
+        _llm_cache.move_to_end(key)
+        if on_chunk:
+            await on_chunk(cached[0])
+        return cached[0]
     try:
-        response = model.generate_content(prompt)
-        return response.text
+        if on_chunk:
+            parts = []
+            async for chunk in await model.generate_content_async(prompt, generation_config=generation_config, stream=True):
+                parts.append(chunk.text)
+                await on_chunk(chunk.text)
+            text = "".join(parts)
+        else:
+            text = await asyncio.to_thread(_generate_text, prompt, generation_config)
     except Exception as e:
         return f"Error: {str(e)}"
+    _llm_cache[key] = (text, time.time())
+    _llm_cache.move_to_end(key)
+    while len(_llm_cache) > LLM_CACHE_MAX_ENTRIES:
+        _llm_cache.popitem(last=False)
+    return text
+
+_NICHE_PROMPT = "Analyze the {industry} industry and identify {depth} highly specific niches. For each provide: 1. Niche Name 2. Market Size 3. Unique Value Zone (UVZ) 4. Target Audience 5. Differentiation 6. Monetization Potential. Format as structured markdown."
+_DRILL_PROMPT = "Deep UVZ analysis for niche: {niche}, focus: {focus}. Provide: Problem Statement, Target Avatar, Current Solutions, The Gap, Value Proposition, Validation Signals, Competition Level, Monetization Pathways, Quick Win Strategy. Be extremely specific."
+_RESEARCH_PROMPT = "Based on these search results about '{topic}', provide: Key Insights, Common Themes, Best Practices, Knowledge Gaps, Content Opportunities.\n\n{sources}"
+_VALIDATION_PROMPT = "Analyze market signals for: {uvz}\n\n{findings}\n\nProvide: Demand Level, Market Signals, Competition Analysis, Opportunity Score (1-10), Red Flags, Green Lights, Recommended Action (Go/No-Go)."
+_OUTLINE_PROMPT = "Create comprehensive ebook outline for: Topic: {topic}, Audience: {audience}, Length: ~{pages} pages. Include: Title, Subtitle, Target Reader, Chapter Structure (10+ chapters with objectives, sections, estimated pages), Unique Selling Points, Key Takeaways, Marketing Hooks."
+_EXPAND_PROMPT = "Expand chapter: {chapter}. Key points: {key_points}. Provide: Opening Hook, Introduction, Main Sections (3-7 with key concepts, talking points, examples, mistakes to avoid, action steps), Chapter Summary, Transition. Include estimated word count and supporting elements needed."
+_CHAPTER_PROMPT = "Write full chapter in {tone} tone: {chapter}\n\nOutline:\n{outline}\n\nRequirements: engaging prose, examples, subheadings, bullet points for lists, actionable takeaways, 2000-3000 words."
+_COMPETITOR_PROMPT = "Analyze competitors for: {uvz}\n\n{competitors}\n\nProvide: Market Saturation, Competitor Strengths, Weaknesses, Market Gaps, Differentiation Strategy, Positioning, Pricing Insights, Content Strategy."
+_PIPELINE_PROMPT = "Analyze the {industry} industry. Respond with only a JSON object with three string keys, each value formatted as structured markdown. \"niches\": identify {depth} highly specific niches, for each provide: 1. Niche Name 2. Market Size 3. Unique Value Zone (UVZ) 4. Target Audience 5. Differentiation 6. Monetization Potential. \"deep_dive\": deep UVZ analysis of {focus}, provide: Problem Statement, Target Avatar, Current Solutions, The Gap, Value Proposition, Validation Signals, Competition Level, Monetization Pathways, Quick Win Strategy. Be extremely specific. \"competitors\": analyze competitors for that UVZ, provide: Market Saturation, Competitor Strengths, Weaknesses, Market Gaps, Differentiation Strategy, Positioning, Pricing Insights, Content Strategy."
+_MARKETING_PROMPTS = {
+    "landing_page": "Create high-converting landing page for: {title}, UVZ: {uvz}. Include: Hero (headline, subheadline, CTA), Problem, Solution, Benefits, Social Proof, Features, Guarantee, Final CTA, FAQ.",
+    "email_sequence": "Create 5-email sequence for: {title}, UVZ: {uvz}. Each email: subject, preview, body (300-500 words), CTA. Emails: 1-Welcome, 2-Story+Problem, 3-Solution, 4-Social Proof, 5-Urgency.",
+    "social_posts": "Create 10 social posts for: {title}, UVZ: {uvz}. Include 3 educational, 3 engagement, 2 promotional, 2 testimonial posts. Each: platform, text, hashtags, visual description.",
+}
 
 @mcp.tool()
 async def identify_industry_niches(industry="", depth="3"):
@@ -64,7 +195,7 @@ async def identify_industry_niches(industry="", depth="3"):
     industry_clean = sanitize_input(industry)
     try:
         depth_int = int(depth) if depth.strip() else 3
-        prompt = f"Analyze the {industry_clean} industry and identify {depth_int} highly specific niches. For each provide: 1. Niche Name 2. Market Size 3. Unique Value Zone (UVZ) 4. Target Audience 5. Differentiation 6. Monetization Potential. Format as structured markdown."
+        prompt = _NICHE_PROMPT.format_map({'industry': industry_clean, 'depth': depth_int})
         analysis = await gemini_analyze(prompt)
         return f"Industry Analysis: {industry_clean}\n\n{analysis}\n\nNext Steps: Use drill_uvz to go deeper"
     except Exception as e:
@@ -80,7 +211,7 @@ async def drill_uvz(niche="", focus_area=""):
     niche_clean = sanitize_input(niche)
     focus_clean = sanitize_input(focus_area) if focus_area.strip() else "general opportunities"
     try:
-        prompt = f"Deep UVZ analysis for niche: {niche_clean}, focus: {focus_clean}. Provide: Problem Statement, Target Avatar, Current Solutions, The Gap, Value Proposition, Validation Signals, Competition Level, Monetization Pathways, Quick Win Strategy. Be extremely specific."
+        prompt = _DRILL_PROMPT.format_map({'niche': niche_clean, 'focus': focus_clean})
         analysis = await gemini_analyze(prompt)
         return f"UVZ Deep Dive: {niche_clean}\n\n{analysis}"
     except Exception as e:
@@ -94,13 +225,12 @@ async def research_uvz_topic(topic="", sources="10"):
     topic_clean = sanitize_input(topic)
     try:
         num_sources = int(sources) if sources.strip() else 10
-        search_results = await web_search_free(f"{topic_clean} guide tutorial best practices")
-        results_data = json.loads(search_results)
+        results_data = await _web_search_free_raw(f"{topic_clean} guide tutorial best practices")
         if not results_data:
             return f"No search results found for: {topic_clean}"
-        sources_text = "\n\n".join([f"{i+1}. {r['title']}\n{r['snippet']}\n{r['link']}" for i, r in enumerate(results_data[:num_sources])])
+        sources_text = _format_sources(results_data, num_sources)
         if model:
-            analysis_prompt = f"Based on these search results about '{topic_clean}', provide: Key Insights, Common Themes, Best Practices, Knowledge Gaps, Content Opportunities.\n\n{sources_text}"
+            analysis_prompt = _RESEARCH_PROMPT.format_map({'topic': topic_clean, 'sources': sources_text})
             ai_analysis = await gemini_analyze(analysis_prompt)
             return f"Research Report: {topic_clean}\n\nAI Analysis:\n{ai_analysis}\n\nSources:\n{sources_text}"
         return f"Research Results: {topic_clean}\n\nSources:\n{sources_text}"
@@ -114,15 +244,17 @@ async def validate_uvz_demand(uvz_description=""):
         return "Error: UVZ description is required"
     uvz_clean = sanitize_input(uvz_description)
     try:
+        queries = [f"{uvz_clean} problems", f"{uvz_clean} solutions needed", f"how to {uvz_clean}"]
+        results_list = await asyncio.gather(*[_web_search_free_raw(q) for q in queries], return_exceptions=True)
         all_results = []
-        for query in [f"{uvz_clean} problems", f"{uvz_clean} solutions needed", f"how to {uvz_clean}"]:
-            results = await web_search_free(query)
-            all_results.extend(json.loads(results)[:3])
+        for results in results_list:
+            if isinstance(results, list):
+                all_results.extend(results[:3])
         if not all_results:
             return f"Limited demand signals found for: {uvz_clean}"
-        findings = "\n\n".join([f"{i+1}. {r['title']}\n{r['snippet']}" for i, r in enumerate(all_results)])
+        findings = _format_sources(all_results, include_links=False)
         if model:
-            validation_prompt = f"Analyze market signals for: {uvz_clean}\n\n{findings}\n\nProvide: Demand Level, Market Signals, Competition Analysis, Opportunity Score (1-10), Red Flags, Green Lights, Recommended Action (Go/No-Go)."
+            validation_prompt = _VALIDATION_PROMPT.format_map({'uvz': uvz_clean, 'findings': findings})
             validation = await gemini_analyze(validation_prompt)
             return f"Demand Validation: {uvz_clean}\n\n{validation}\n\nRaw Signals:\n{findings}"
         return f"Market Signals: {uvz_clean}\n\n{findings}"
@@ -140,7 +272,7 @@ async def generate_ebook_outline(topic="", audience="", length="50"):
     audience_clean = sanitize_input(audience) if audience.strip() else "general audience"
     try:
         page_count = int(length) if length.strip() else 50
-        prompt = f"Create comprehensive ebook outline for: Topic: {topic_clean}, Audience: {audience_clean}, Length: ~{page_count} pages. Include: Title, Subtitle, Target Reader, Chapter Structure (10+ chapters with objectives, sections, estimated pages), Unique Selling Points, Key Takeaways, Marketing Hooks."
+        prompt = _OUTLINE_PROMPT.format_map({'topic': topic_clean, 'audience': audience_clean, 'pages': page_count})
         outline = await gemini_analyze(prompt)
         return f"Ebook Outline Generated\n\n{outline}"
     except Exception as e:
@@ -156,14 +288,14 @@ async def expand_chapter(chapter_title="", key_points=""):
     chapter_clean = sanitize_input(chapter_title)
     points_clean = key_points if key_points.strip() else "Cover the main aspects"
     try:
-        prompt = f"Expand chapter: {chapter_clean}. Key points: {points_clean}. Provide: Opening Hook, Introduction, Main Sections (3-7 with key concepts, talking points, examples, mistakes to avoid, action steps), Chapter Summary, Transition. Include estimated word count and supporting elements needed."
+        prompt = _EXPAND_PROMPT.format_map({'chapter': chapter_clean, 'key_points': points_clean})
         expansion = await gemini_analyze(prompt)
         return f"Chapter Expansion: {chapter_clean}\n\n{expansion}"
     except Exception as e:
         return f"Error: {str(e)}"
 
 @mcp.tool()
-async def generate_chapter_content(chapter_title="", outline="", tone="professional"):
+async def generate_chapter_content(chapter_title="", outline="", tone="professional", ctx: Context = None):
     """Generate full written content for a chapter based on the expanded outline."""
     if not chapter_title.strip() or not outline.strip():
         return "Error: Chapter title and outline required"
@@ -172,8 +304,14 @@ async def generate_chapter_content(chapter_title="", outline="", tone="professio
     chapter_clean = sanitize_input(chapter_title)
     tone_clean = sanitize_input(tone)
     try:
-        prompt = f"Write full chapter in {tone_clean} tone: {chapter_clean}\n\nOutline:\n{outline}\n\nRequirements: engaging prose, examples, subheadings, bullet points for lists, actionable takeaways, 2000-3000 words."
-        content = await gemini_analyze(prompt)
+        prompt = _CHAPTER_PROMPT.format_map({'tone': tone_clean, 'chapter': chapter_clean, 'outline': outline})
+        streamed_words = 0
+        async def report_words(chunk):
+            nonlocal streamed_words
+            streamed_words += len(chunk.split())
+            if ctx:
+                await ctx.report_progress(streamed_words)
+        content = await gemini_analyze(prompt, on_chunk=report_words)
         word_count = len(content.split())
         return f"Chapter Content: {chapter_clean}\n\n{content}\n\nStats: ~{word_count} words, {tone_clean} tone"
     except Exception as e:
@@ -187,19 +325,43 @@ async def competitive_analysis(uvz="", competitors="5"):
     uvz_clean = sanitize_input(uvz)
     try:
         num_competitors = int(competitors) if competitors.strip() else 5
-        search_results = await web_search_free(f"{uvz_clean} courses guides products solutions")
-        results_data = json.loads(search_results)
+        results_data = await _web_search_free_raw(f"{uvz_clean} courses guides products solutions")
         if not results_data:
             return f"No competitors found for: {uvz_clean}"
-        competitors_text = "\n\n".join([f"{i+1}. {r['title']}\n{r['snippet']}\n{r['link']}" for i, r in enumerate(results_data[:num_competitors])])
+        competitors_text = _format_sources(results_data, num_competitors)
         if model:
-            analysis_prompt = f"Analyze competitors for: {uvz_clean}\n\n{competitors_text}\n\nProvide: Market Saturation, Competitor Strengths, Weaknesses, Market Gaps, Differentiation Strategy, Positioning, Pricing Insights, Content Strategy."
+            analysis_prompt = _COMPETITOR_PROMPT.format_map({'uvz': uvz_clean, 'competitors': competitors_text})
             analysis = await gemini_analyze(analysis_prompt)
             return f"Competitive Analysis: {uvz_clean}\n\n{analysis}\n\nCompetitors:\n{competitors_text}"
         return f"Competitors: {uvz_clean}\n\n{competitors_text}"
     except Exception as e:
         return f"Error: {str(e)}"
 
+@mcp.tool()
+async def full_uvz_pipeline(industry="", niche_focus="", depth="3"):
+    """Run niche identification UVZ deep dive and competitive analysis for an industry in a single AI call."""
+    if not industry.strip():
+        return "Error: Industry name is required"
+    if not model:
+        return "Error: Gemini API key not configured"
+    industry_clean = sanitize_input(industry)
+    focus_clean = sanitize_input(niche_focus) if niche_focus.strip() else "the most promising niche"
+    try:
+        depth_int = int(depth) if depth.strip() else 3
+        prompt = _PIPELINE_PROMPT.format_map({'industry': industry_clean, 'depth': depth_int, 'focus': focus_clean})
+        analysis = await gemini_analyze(prompt, json_output=True)
+        if analysis.startswith("Error:"):
+            return analysis
+        try:
+            sections = orjson.loads(analysis)
+        except ValueError:
+            sections = None
+        if not isinstance(sections, dict):
+            return f"UVZ Pipeline: {industry_clean}\n\n{analysis}"
+        return f"UVZ Pipeline: {industry_clean}\n\nNiches:\n{_render_section(sections.get('niches', ''))}\n\nUVZ Deep Dive: {focus_clean}\n{_render_section(sections.get('deep_dive', ''))}\n\nCompetitive Analysis:\n{_render_section(sections.get('competitors', ''))}"
+    except Exception as e:
+        return f"Error: {str(e)}"
+
 @mcp.tool()
 async def generate_marketing_copy(product_title="", uvz="", copy_type="landing_page"):
     """Generate marketing copy for a digital product including landing page email sequences or social posts."""
@@ -211,14 +373,9 @@ async def generate_marketing_copy(product_title="", uvz="", copy_type="landing_p
     uvz_clean = sanitize_input(uvz)
     copy_type_clean = sanitize_input(copy_type)
     try:
-        if copy_type_clean == "landing_page":
-            prompt = f"Create high-converting landing page for: {title_clean}, UVZ: {uvz_clean}. Include: Hero (headline, subheadline, CTA), Problem, Solution, Benefits, Social Proof, Features, Guarantee, Final CTA, FAQ."
-        elif copy_type_clean == "email_sequence":
-            prompt = f"Create 5-email sequence for: {title_clean}, UVZ: {uvz_clean}. Each email: subject, preview, body (300-500 words), CTA. Emails: 1-Welcome, 2-Story+Problem, 3-Solution, 4-Social Proof, 5-Urgency."
-        elif copy_type_clean == "social_posts":
-            prompt = f"Create 10 social posts for: {title_clean}, UVZ: {uvz_clean}. Include 3 educational, 3 engagement, 2 promotional, 2 testimonial posts. Each: platform, text, hashtags, visual description."
-        else:
+        if copy_type_clean not in _MARKETING_PROMPTS:
             return "Error: Unknown copy type. Use: landing_page, email_sequence, or social_posts"
+        prompt = _MARKETING_PROMPTS[copy_type_clean].format_map({'title': title_clean, 'uvz': uvz_clean})
         copy_content = await gemini_analyze(prompt)
         return f"Marketing Copy: {copy_type_clean}\n\nProduct: {title_clean}\n\n{copy_content}"
     except Exception as e: